@@ -1,13 +1,34 @@
 import argparse
+import functools
+import hashlib
 import html
+import json
 import mimetypes
+import os
 import re
 import shutil
 import subprocess
+import sys
 import tempfile
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass, field
+from itertools import repeat
 from pathlib import Path
-from typing import Dict, Iterable, List, Match, Optional, Sequence, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 import markdown
 import yaml
@@ -15,6 +36,60 @@ from ebooklib import epub
 from tqdm import tqdm
 from weasyprint import CSS, HTML
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    # PyYAML built without libyaml; use the pure-Python loader.
+    from yaml import SafeLoader as YamlLoader
+
+if TYPE_CHECKING:
+    # Optional dependency, imported lazily by markdown_it_converter().
+    from markdown_it import MarkdownIt
+
+
+def install_lexer_cache() -> None:
+    """Memoize codehilite's Pygments lexer lookups.
+
+    codehilite resolves the lexer for every fenced block, scanning the
+    Pygments registry each time. Lexers hold only their options, so one
+    instance per (name, options) can be shared between blocks.
+    """
+
+    try:
+        from markdown.extensions import codehilite
+        from pygments.lexers import get_lexer_by_name
+    except ImportError:
+        # Without Pygments codehilite emits plain <pre><code> blocks.
+        return
+
+    lexers: Dict[Tuple[object, ...], object] = {}
+
+    def cached_get_lexer_by_name(name: str, **options: object) -> object:
+        key = (name,) + tuple(
+            (option, tuple(value) if isinstance(value, list) else value)
+            for option, value in sorted(options.items())
+        )
+        try:
+            lexer = lexers.get(key)
+        except TypeError:
+            return get_lexer_by_name(name, **options)
+        if lexer is None:
+            lexer = lexers[key] = get_lexer_by_name(name, **options)
+        return lexer
+
+    codehilite.get_lexer_by_name = cached_get_lexer_by_name
+
+
+install_lexer_cache()
+
+CACHE_DIR = Path.home() / ".cache" / "md2book"
+MARKDOWN_EXTENSIONS = ["fenced_code", "tables", "codehilite", "toc", "attr_list"]
+PARSERS = ("markdown", "markdown-it")
+# Bump when post-processing of parsed chapters changes.
+CHAPTER_CACHE_VERSION = 2
+# Cached chapters not read or written for this long are deleted.
+CHAPTER_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
 
 @dataclass
 class BookConfig:
@@ -76,7 +151,7 @@ class BookConfig:
     def from_yaml(cls, path: Optional[Path]) -> "BookConfig":
         if path is None:
             return cls()
-        data = yaml.safe_load(path.read_text(encoding="utf-8")) or {}
+        data = yaml.load(path.read_bytes(), Loader=YamlLoader) or {}
         return cls(**{**cls().__dict__, **data})
 
 
@@ -86,16 +161,49 @@ class Chapter:
     source_path: Path
     html: str
     anchor: str
+    # (level, id, text) with text already HTML-escaped.
+    headings: List[Tuple[int, str, str]] = field(default_factory=list)
+    safe_title: str = ""
+
+
+SLUG_STRIP_PATTERN = re.compile(r"[^\w\-\u0080-\uffff]")
 
 
 def slugify_title(title: str) -> str:
     """Create a URL-friendly anchor while keeping non-latin characters intact."""
 
-    slug = re.sub(r"\s+", "-", title.strip())
-    slug = re.sub(r"[^\w\-\u0080-\uffff]", "", slug)
+    slug = SLUG_STRIP_PATTERN.sub("", "-".join(title.split()))
     return slug.lower() or "section"
 
 
+# Accepts either quote style so raw <img> tags written in the Markdown are
+# handled like the ones python-markdown emits; \s keeps data-src out.
+IMG_SRC_PATTERN = re.compile(
+    r"""(<img\b[^>]*?\ssrc=(["']))((?:(?!\2).)+)(\2)""", re.IGNORECASE | re.DOTALL
+)
+
+
+def mark_chapter_title(html: str, heading_id: str) -> str:
+    """Add the chapter-title class to the h1 carrying ``heading_id``."""
+
+    id_pos = html.find(f'id="{heading_id}"')
+    if id_pos == -1:
+        return html
+    tag_start = html.rfind("<h1", 0, id_pos)
+    if tag_start == -1:
+        return html
+    tag_end = html.find(">", id_pos)
+    if tag_end == -1 or html.find(">", tag_start, id_pos) != -1:
+        return html
+    # Extend an existing class attribute (e.g. from attr_list) rather than
+    # adding a second one, which parsers would ignore.
+    class_pos = html.find(' class="', tag_start, tag_end)
+    if class_pos != -1:
+        value_start = class_pos + len(' class="')
+        return f"{html[:value_start]}chapter-title {html[value_start:]}"
+    return f'{html[:tag_end]} class="chapter-title"{html[tag_end:]}'
+
+
 def normalize_heading_ids(
     html: str, level_one: List[Dict[str, str]], anchor: str
 ) -> Tuple[str, List[Tuple[str, str]]]:
@@ -110,20 +218,10 @@ def normalize_heading_ids(
         suffix = seen_ids.get(base_id, 0)
         seen_ids[base_id] = suffix + 1
         new_id = base_id if suffix == 0 else f"{base_id}-{suffix}"
-        html = re.sub(
-            rf'id="{re.escape(original_id)}"',
-            f'id="{new_id}"',
-            html,
-            count=1,
-        )
+        html = html.replace(f'id="{original_id}"', f'id="{new_id}"', 1)
         if idx == 0:
             # Mark the first heading for running headers.
-            html = re.sub(
-                rf"<h1([^>]*id=\"{re.escape(new_id)}\"[^>]*)>",
-                r"<h1\1 class=\"chapter-title\">",
-                html,
-                count=1,
-            )
+            html = mark_chapter_title(html, new_id)
         normalized.append((new_id, heading_text))
 
     # Ensure the chapter still exposes a title for headers even without h1.
@@ -133,28 +231,48 @@ def normalize_heading_ids(
     return html, normalized
 
 
-def collect_heading_links(html: str) -> List[Tuple[int, str, str]]:
-    """Collect normalized level-one and level-two headings for TOC linking."""
+def collect_heading_links(
+    toc_tokens: List[Dict[str, object]], normalized: List[Tuple[str, str]]
+) -> List[Tuple[int, str, str]]:
+    """Collect level-one and level-two headings for TOC linking.
+
+    Walks the Markdown toc tokens instead of re-scanning the chapter HTML;
+    level-one ids are taken from ``normalized`` so they match the rewritten
+    headings.
+    """
 
     headings: List[Tuple[int, str, str]] = []
-    for match in re.finditer(
-        r"<h([1-2])[^>]*id=\"([^\"]+)\"[^>]*>(.*?)</h\1>",
-        html,
-        flags=re.IGNORECASE | re.DOTALL,
-    ):
-        level = int(match.group(1))
-        text = re.sub(r"<[^>]+>", "", match.group(3)).strip()
-        headings.append((level, match.group(2), text))
+    level_one_ids = iter(new_id for new_id, _ in normalized)
+
+    def walk(tokens: List[Dict[str, object]]) -> None:
+        for token in tokens:
+            level = token["level"]
+            if level == 1:
+                headings.append((1, next(level_one_ids), token["name"]))
+            elif level == 2:
+                headings.append((2, token["id"], token["name"]))
+            if level < 2:
+                walk(token.get("children", []))
+
+    walk(toc_tokens)
     return headings
 
 
 VALID_TAG_NAME = re.compile(r"^[A-Za-z_][\w.:-]*$")
 POSSIBLE_TAG = re.compile(r"<(?P<tag>[^\s/>]+)(?P<rest>[^>]*)>")
+# Finds any fragment POSSIBLE_TAG would escape; well-formed tags,
+# declarations and processing instructions are rejected by the lookaheads.
+INVALID_TAG = re.compile(r"<(?![!?])(?![A-Za-z_][\w.:-]*[\s/>])[^\s/>]+[^>]*>")
 
 
 def escape_invalid_html_tags(content: str) -> str:
     """Escape malformed HTML-like fragments so EPUB XHTML stays valid."""
 
+    # Most chapters have no malformed tags; one scan proves it without
+    # calling back into Python for every tag.
+    if INVALID_TAG.search(content) is None:
+        return content
+
     def replace(match: Match[str]) -> str:
         tag = match.group("tag")
         # Keep declarations and processing instructions untouched.
@@ -171,154 +289,465 @@ def escape_invalid_html_tags(content: str) -> str:
 
 
 def build_nested_toc(headings: List[Tuple[int, str, str]], config: BookConfig) -> str:
-    """Build a nested unordered list from heading tuples (level, id, text)."""
-
-    if not headings:
-        return ""
-
-    root = {"level": 1, "children": []}
-    stack = [root]
-
-    for level, hid, text in headings:
-        node = {"level": level, "id": hid, "text": text, "children": []}
-        while len(stack) > 1 and level <= stack[-1]["level"]:
-            stack.pop()
-        stack[-1]["children"].append(node)
-        stack.append(node)
-
-    def render_children(nodes: List[Dict[str, object]]) -> str:
-        if not nodes:
-            return ""
-
-        items: List[str] = []
-        for node in nodes:
-            children_html = render_children(node["children"])
-            items.append(
-                f"<li><a href='#{node['id']}'>{node['text']}</a>{children_html}</li>"
-            )
+    """Build a nested unordered list from heading tuples (level, id, text).
 
-        return f"<ul>{''.join(items)}</ul>"
+    Heading text must already be HTML-escaped (see Chapter.headings).
 
-    def render_nodes(nodes: List[Dict[str, object]]) -> str:
-        html_parts: List[str] = []
+    Top-level level-one headings become <h2>/<h3> entries and everything
+    beneath them nested <ul>/<li> items. Emitted in one pass; the open
+    entries are tracked in parallel lists (level, closing tag, whether a
+    child <ul> was opened) rather than per-node objects.
+    """
 
-        for node in nodes:
-            children_html = render_children(node["children"])
+    parts: List[str] = []
+    open_levels: List[int] = []
+    open_closers: List[str] = []
+    open_lists: List[bool] = []
+
+    def close() -> None:
+        open_levels.pop()
+        if open_lists.pop():
+            parts.append("</ul>")
+        parts.append(open_closers.pop())
+
+    for idx, (level, hid, text) in enumerate(headings):
+        while open_levels and level <= open_levels[-1]:
+            close()
+        link = f"<a href='#{hid}'>{text}</a>"
+
+        if open_levels:
+            if not open_lists[-1]:
+                parts.append("<ul>")
+                open_lists[-1] = True
+            parts.append(f"<li>{link}")
+            closer = "</li>"
+        elif level == 1:
+            has_children = idx + 1 < len(headings) and headings[idx + 1][0] > level
+            tag = (
+                "h2"
+                if not has_children and config.chapter_word_included in text
+                else "h3"
+            )
+            parts.append(f"<{tag}>{link}</{tag}>")
+            closer = ""
+        else:
+            parts.append(f"<li>{link}")
+            closer = "</li>"
 
-            if node["level"] == 1:
-                if len(node["children"]) == 0 and config.chapter_word_included in node["text"]:
-                    html_parts.append(
-                        f"<h2><a href='#{node['id']}'>{node['text']}</a></h2>{children_html}"
-                    )
-                else:
-                    html_parts.append(
-                        f"<h3><a href='#{node['id']}'>{node['text']}</a></h3>{children_html}"
-                    )
-            else:
-                html_parts.append(
-                    f"<li><a href='#{node['id']}'>{node['text']}</a>{children_html}</li>"
-                )
+        open_levels.append(level)
+        open_closers.append(closer)
+        open_lists.append(False)
 
-        return "".join(html_parts)
+    while open_levels:
+        close()
 
-    return render_nodes(root["children"])
+    return "".join(parts)
 
 
-def discover_images(
+def embed_images(
     html: str,
     base_dir: Path,
-    added_resources: Dict[Path, epub.EpubItem],
-) -> List[Tuple[str, epub.EpubItem]]:
-    """Find image sources in HTML and prepare EpubImage resources."""
+    added_resources: Dict[str, epub.EpubItem],
+    resources_by_digest: Dict[str, epub.EpubItem],
+) -> str:
+    """Register local images as EpubImage resources and point <img> tags at them.
+
+    Discovery and rewriting happen in the same regex pass. Resources are
+    shared by normalized path and, for copies of the same image at
+    different paths, by a SHA-1 of the file contents.
+    """
+
+    base_str = str(base_dir.resolve())
+    images: Dict[str, Optional[epub.EpubItem]] = {}
 
-    images: List[Tuple[str, epub.EpubItem]] = []
-    for match in re.finditer(r"<img[^>]+src=\"([^\"]+)\"", html, flags=re.IGNORECASE):
-        src = match.group(1)
+    def lookup(src: str) -> Optional[epub.EpubItem]:
         if (
             src.startswith("http://")
             or src.startswith("https://")
             or src.startswith("data:")
         ):
-            continue
-        resolved = (base_dir / src).resolve()
-        if not resolved.exists():
-            continue
-        if resolved in added_resources:
-            resource = added_resources[resolved]
-        else:
+            return None
+        # normpath is pure string work; resolve() would stat every component.
+        candidate = os.path.normpath(os.path.join(base_str, src))
+        if candidate in added_resources:
+            return added_resources[candidate]
+        if not os.path.isfile(candidate):
+            return None
+        resolved = Path(candidate)
+        content = resolved.read_bytes()
+        digest = hashlib.sha1(content).hexdigest()
+        resource = resources_by_digest.get(digest)
+        if resource is None:
             media_type, _ = mimetypes.guess_type(resolved.name)
-            file_name = f"images/{len(added_resources) + 1}_{resolved.name}"
+            file_name = f"images/{len(resources_by_digest) + 1}_{resolved.name}"
             resource = epub.EpubImage(
                 uid=file_name,
                 file_name=file_name,
                 media_type=media_type or "image/jpeg",
-                content=resolved.read_bytes(),
+                content=content,
             )
-            added_resources[resolved] = resource
-        images.append((src, resource))
-    return images
+            resources_by_digest[digest] = resource
+        added_resources[candidate] = resource
+        return resource
+
+    def replace(match: Match[str]) -> str:
+        src = match.group(3)
+        if src not in images:
+            images[src] = lookup(src)
+        resource = images[src]
+        if resource is None:
+            return match.group(0)
+        return f"{match.group(1)}{resource.file_name}{match.group(4)}"
+
+    return IMG_SRC_PATTERN.sub(replace, html)
+
+
+MARKDOWN_SUFFIXES = (".md", ".markdown")
+
+
+def walk_markdown_files(root: Path) -> List[Path]:
+    """Collect Markdown files under ``root`` in one directory walk.
+
+    Uses ``os.scandir`` directly so file types come from the directory
+    listing, and skips ``.git`` (large in cached clones, never has chapters).
+    """
+
+    found: List[str] = []
+    pending = [os.fspath(root)]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            # Like os.walk, skip directories we cannot list.
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != ".git":
+                        pending.append(entry.path)
+                elif entry.name.lower().endswith(MARKDOWN_SUFFIXES) and entry.is_file():
+                    found.append(entry.path)
+    return sorted(map(Path, found))
 
 
 def discover_markdown_files(paths: Iterable[Path]) -> List[Path]:
-    files: List[Path] = []
+    files: Dict[Path, None] = {}
     for path in paths:
-        if path.is_file() and path.suffix.lower() in {".md", ".markdown"}:
-            files.append(path)
+        if path.is_file() and path.suffix.lower() in MARKDOWN_SUFFIXES:
+            files[path] = None
         elif path.is_dir():
-            files.extend(sorted(path.rglob("*.md")))
-            files.extend(sorted(path.rglob("*.markdown")))
-    unique_files: List[Path] = []
-    seen = set()
-    for file in files:
-        if file not in seen:
-            seen.add(file)
-            unique_files.append(file)
-    return unique_files
-
-
-def prioritize_files(files: List[Path]) -> List[Path]:
-    """Place preface-like files first while keeping original order otherwise."""
-
-    preface_indices = [
-        idx for idx, path in enumerate(files) if path.stem.lower() == "preface"
-    ]
-    if not preface_indices:
-        return files
+            files.update(dict.fromkeys(walk_markdown_files(path)))
+    return list(files)
+
+
+def filter_and_prioritize(files: Sequence[Path], exclude: FrozenSet[str]) -> List[Path]:
+    """Drop excluded pages and move the first preface to the front, in one pass.
+
+    ``exclude`` holds lower-cased file stems.
+    """
+
+    kept: List[Path] = []
+    preface: Optional[Path] = None
+    for path in files:
+        stem = path.stem.lower()
+        if stem in exclude:
+            continue
+        if preface is None and stem == "preface":
+            preface = path
+        else:
+            kept.append(path)
+    if preface is not None:
+        kept.insert(0, preface)
+    return kept
 
-    first_preface = preface_indices[0]
-    preface_file = files[first_preface]
-    remaining = [file for idx, file in enumerate(files) if idx != first_preface]
-    return [preface_file] + remaining
+
+# Only the tip of the default branch is ever read; skip other branches and tags.
+GIT_CLONE_ARGS = ("clone", "--depth", "1", "--single-branch", "--no-tags")
 
 
 def clone_repository(url: str, workspace: Path) -> Path:
     repo_dir = workspace / "repo"
-    subprocess.run(["git", "clone", "--depth", "1", url, str(repo_dir)], check=True)
+    subprocess.run(["git", *GIT_CLONE_ARGS, url, str(repo_dir)], check=True)
+    return repo_dir
+
+
+def repo_cache_writable() -> bool:
+    """Return True if repository clones can be kept under ``CACHE_DIR``."""
+
+    repos_dir = CACHE_DIR / "repos"
+    try:
+        repos_dir.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return False
+    return os.access(repos_dir, os.W_OK)
+
+
+def update_cached_repository(url: str) -> Path:
+    """Clone ``url`` into the cache, or fast-forward an existing cached clone."""
+
+    repo_dir = CACHE_DIR / "repos" / hashlib.sha1(url.encode("utf-8")).hexdigest()
+    if (repo_dir / ".git").exists():
+        git = ["git", "-C", str(repo_dir)]
+        try:
+            subprocess.run(
+                git + ["fetch", "--depth", "1", "--no-tags", "origin", "HEAD"],
+                check=True,
+            )
+            subprocess.run(git + ["reset", "--hard", "FETCH_HEAD"], check=True)
+        except (OSError, subprocess.CalledProcessError) as exc:
+            # Keep the existing checkout; a failed update (e.g. offline) should
+            # not throw away a complete clone.
+            print(
+                f"Warning: could not update cached clone of {url} ({exc}); "
+                "using the cached copy",
+                file=sys.stderr,
+            )
+        return repo_dir
+
+    try:
+        repo_dir.parent.mkdir(parents=True, exist_ok=True)
+        subprocess.run(["git", *GIT_CLONE_ARGS, url, str(repo_dir)], check=True)
+    except (OSError, subprocess.CalledProcessError):
+        # Drop a half-written clone so the next run starts clean.
+        shutil.rmtree(repo_dir, ignore_errors=True)
+        raise
     return repo_dir
 
 
-def load_chapters(paths: Sequence[Path]) -> List[Chapter]:
+@functools.lru_cache(maxsize=None)
+def parser_version(parser: str) -> str:
+    """Return the installed version of the library behind ``parser``."""
+
+    if parser == "markdown-it":
+        # Raises the install hint when markdown-it-py is missing.
+        markdown_it_converter()
+        import markdown_it
+
+        return markdown_it.__version__
+    return markdown.__version__
+
+
+def chapter_cache_key(source: bytes, parser: str) -> str:
+    """Key cached chapters by content, parser and everything that shapes the output."""
+
+    digest = hashlib.blake2b(source, digest_size=16)
+    digest.update(
+        json.dumps(
+            [
+                CHAPTER_CACHE_VERSION,
+                parser,
+                parser_version(parser),
+                MARKDOWN_EXTENSIONS,
+            ]
+        ).encode("utf-8")
+    )
+    return digest.hexdigest()
+
+
+def load_cached_chapter(key: str) -> Optional[Tuple[str, List[Dict[str, object]]]]:
+    """Return cached (html, toc_tokens) for a chapter cache key, if present."""
+
+    cache_path = CACHE_DIR / "chapters" / f"{key}.json"
+    try:
+        payload = json.loads(cache_path.read_bytes())
+        result = payload["html"], payload["toc"]
+    except (OSError, ValueError, KeyError):
+        return None
+    try:
+        # Refresh the mtime so entries still in use survive pruning.
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return result
+
+
+def store_cached_chapter(
+    key: str, html: str, toc_tokens: List[Dict[str, object]]
+) -> None:
+    cache_path = CACHE_DIR / "chapters" / f"{key}.json"
+    temp_name: Optional[str] = None
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so a concurrent reader never sees a partial file.
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=cache_path.parent, delete=False
+        ) as handle:
+            temp_name = handle.name
+            json.dump({"html": html, "toc": toc_tokens}, handle, ensure_ascii=False)
+        os.replace(temp_name, cache_path)
+    except (OSError, TypeError, ValueError):
+        # The cache is an optimization only; an unwritable cache dir (or an
+        # entry json cannot encode) just means the chapter is parsed again.
+        if temp_name is not None:
+            try:
+                os.unlink(temp_name)
+            except OSError:
+                pass
+
+
+def prune_chapter_cache(max_age: float = CHAPTER_CACHE_MAX_AGE) -> None:
+    """Delete cached chapters (and stray temp files) unused for ``max_age`` seconds."""
+
+    cutoff = time.time() - max_age
+    try:
+        entries = list(os.scandir(CACHE_DIR / "chapters"))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+@functools.lru_cache(maxsize=None)
+def markdown_converter() -> markdown.Markdown:
+    """Return this process's shared Markdown instance."""
+
+    return markdown.Markdown(extensions=MARKDOWN_EXTENSIONS, output_format="xhtml1")
+
+
+@functools.lru_cache(maxsize=None)
+def markdown_it_converter() -> "MarkdownIt":
+    """Return this process's shared markdown-it-py parser."""
+
+    try:
+        from markdown_it import MarkdownIt
+    except ImportError as exc:
+        raise ImportError(
+            "The markdown-it parser requires the markdown-it-py package. "
+            "Install it with `pip install markdown-it-py` and retry."
+        ) from exc
+
+    return MarkdownIt("commonmark", {"html": True}).enable("table")
+
+
+def convert_with_markdown_it(markdown_text: str) -> Tuple[str, List[Dict[str, object]]]:
+    """Render with markdown-it-py, returning python-markdown style toc tokens.
+
+    Heading ids are assigned while walking the token stream, so the toc
+    comes straight from the parse instead of a second pass over the HTML.
+    """
+
+    md = markdown_it_converter()
+    tokens = md.parse(markdown_text)
+    toc_tokens: List[Dict[str, object]] = []
+    open_tokens: List[Dict[str, object]] = []
+    used_ids = set()
+
+    for idx, token in enumerate(tokens):
+        if token.type != "heading_open":
+            continue
+        inline = tokens[idx + 1]
+        name = "".join(
+            child.content
+            for child in inline.children or []
+            if child.type in {"text", "code_inline"}
+        ).strip()
+        base_id = slugify_title(name)
+        heading_id = base_id
+        suffix = 1
+        while heading_id in used_ids:
+            heading_id = f"{base_id}_{suffix}"
+            suffix += 1
+        used_ids.add(heading_id)
+        token.attrSet("id", heading_id)
+
+        level = int(token.tag[1])
+        toc_token: Dict[str, object] = {
+            "level": level,
+            "id": heading_id,
+            "name": html.escape(name, quote=False),
+            "children": [],
+        }
+        while open_tokens and open_tokens[-1]["level"] >= level:
+            open_tokens.pop()
+        if open_tokens:
+            open_tokens[-1]["children"].append(toc_token)
+        else:
+            toc_tokens.append(toc_token)
+        open_tokens.append(toc_token)
+
+    return md.renderer.render(tokens, md.options, {}), toc_tokens
+
+
+def parse_markdown_file(
+    path: Path, use_cache: bool = True, parser: str = "markdown"
+) -> Tuple[str, List[Dict[str, object]]]:
+    """Convert one Markdown file to (html, toc_tokens), using the cache if allowed."""
+
+    source = path.read_bytes()
+    cache_key = chapter_cache_key(source, parser) if use_cache else ""
+    cached = load_cached_chapter(cache_key) if use_cache else None
+    if cached is not None:
+        return cached
+
+    # utf-8-sig drops a leading BOM, which would otherwise hide a first-line heading.
+    markdown_text = source.decode("utf-8-sig")
+    if parser == "markdown-it":
+        chapter_html, toc_tokens = convert_with_markdown_it(markdown_text)
+    else:
+        md = markdown_converter()
+        chapter_html = md.reset().convert(markdown_text)
+        toc_tokens = md.toc_tokens or []
+    chapter_html = escape_invalid_html_tags(chapter_html)
+    if use_cache:
+        store_cached_chapter(cache_key, chapter_html, toc_tokens)
+    return chapter_html, toc_tokens
+
+
+def load_chapters(
+    paths: Sequence[Path],
+    use_cache: bool = True,
+    jobs: int = 1,
+    parser: str = "markdown",
+    executor: Optional[ProcessPoolExecutor] = None,
+) -> List[Chapter]:
+    """Parse ``paths`` into chapters, in parallel when ``jobs`` > 1.
+
+    Pass ``executor`` to reuse a caller's pool instead of starting a new one.
+    """
+
+    # Parsing is independent per file; only the anchor numbering below
+    # depends on order, so it stays serial.
+    if jobs > 1 and len(paths) > 2:
+        workers = min(jobs, len(paths))
+        # A few chunks per worker balances uneven chapter sizes without
+        # leaving workers idle on short books.
+        chunksize = max(1, len(paths) // (workers * 4))
+        pool = (
+            nullcontext(executor)
+            if executor is not None
+            else ProcessPoolExecutor(max_workers=workers)
+        )
+        with pool as active:
+            parsed = list(
+                active.map(
+                    parse_markdown_file,
+                    paths,
+                    repeat(use_cache),
+                    repeat(parser),
+                    chunksize=chunksize,
+                )
+            )
+    else:
+        parsed = [parse_markdown_file(path, use_cache, parser) for path in paths]
+    if use_cache:
+        prune_chapter_cache()
+
     chapters: List[Chapter] = []
     slug_counts: Dict[str, int] = {}
-    for path in paths:
-        markdown_text = path.read_text(encoding="utf-8")
-        md = markdown.Markdown(
-            extensions=[
-                "fenced_code",
-                "tables",
-                "codehilite",
-                "toc",
-                "attr_list",
-            ],
-            output_format="xhtml1",
-        )
-        html = md.convert(markdown_text)
-        html = escape_invalid_html_tags(html)
-        toc_tokens = md.toc_tokens or []
+    for path, (chapter_html, toc_tokens) in zip(paths, parsed):
         level_one = [token for token in toc_tokens if token.get("level") == 1]
+        # toc token names are already HTML-escaped; keep the plain title for
+        # metadata and escape it exactly once for markup.
         title = (
-            level_one[0]["name"] if level_one else path.stem.replace("_", " ").title()
+            html.unescape(level_one[0]["name"])
+            if level_one
+            else path.stem.replace("_", " ").title()
         )
+        safe_title = html.escape(title, quote=True)
         # Use the file stem as a stable anchor (e.g. ch01, preface)
         # so that header links end with ch01-style identifiers instead of
         # title-based slugs which may include localized characters.
@@ -327,20 +756,126 @@ def load_chapters(paths: Sequence[Path]) -> List[Chapter]:
         slug_counts[anchor_base] = anchor_suffix + 1
         anchor = anchor_base if anchor_suffix == 0 else f"{anchor_base}-{anchor_suffix}"
 
-        html, _ = normalize_heading_ids(html, level_one, anchor)
+        chapter_html, normalized = normalize_heading_ids(
+            chapter_html, level_one, anchor
+        )
+        headings = collect_heading_links(toc_tokens, normalized)
+        if not level_one:
+            # Give chapters without an h1 a title heading once, here, so the
+            # renderers never have to search the HTML for one.
+            chapter_html = (
+                f"<h1 id='{anchor}' class='chapter-title'>{safe_title}</h1>"
+                + chapter_html
+            )
+            headings.insert(0, (1, anchor, safe_title))
 
         chapters.append(
             Chapter(
                 title=title,
                 source_path=path,
-                html=html,
+                html=chapter_html,
                 anchor=anchor,
+                headings=headings,
+                safe_title=safe_title,
             )
         )
     return chapters
 
 
-def build_css(config: BookConfig) -> str:
+# Element selectors whose rules are only emitted when the book uses the tag.
+STYLED_ELEMENT_TAGS = frozenset(
+    ("pre", "code", "blockquote", "hr", "table", "img", "figure")
+)
+STYLED_ELEMENT_PATTERN = re.compile(
+    r"<(" + "|".join(STYLED_ELEMENT_TAGS) + r")[\s/>]", re.I
+)
+
+
+# The BookConfig fields render_css reads; the stylesheet memo is keyed on these
+# alone, so keep the list in step with render_css.
+CSS_CONFIG_FIELDS = (
+    "page_size",
+    "margin_top",
+    "margin_right",
+    "margin_bottom",
+    "margin_left",
+    "font_family",
+    "heading_font_family",
+    "chapter_title_font_family",
+    "code_font_family",
+    "table_font_family",
+    "base_font_size",
+    "line_height",
+    "text_color",
+    "background_color",
+    "heading_color",
+    "heading_color_h1",
+    "heading_color_h2",
+    "heading_color_h3",
+    "link_color",
+    "code_background_color",
+    "code_border_color",
+    "table_cell_padding",
+    "header_enabled",
+    "header_font_size",
+    "header_border_color",
+    "footer_enabled",
+    "footer_font_size",
+    "footer_border_color",
+    "chapter_page_break",
+    "pdf_cover",
+    "toc",
+    "extra_css",
+)
+
+
+def collect_styled_tags(
+    chapters: Sequence[Chapter], config: BookConfig
+) -> FrozenSet[str]:
+    """Return the styled element tags that appear anywhere in the book."""
+
+    found = set()
+    if config.pdf_cover:
+        found.add("img")
+    fragments = [config.footer_html, render_author_html(config.author)]
+    fragments.extend(chapter.html for chapter in chapters)
+    for fragment in fragments:
+        found.update(
+            match.group(1).lower()
+            for match in STYLED_ELEMENT_PATTERN.finditer(fragment)
+        )
+        if len(found) == len(STYLED_ELEMENT_TAGS):
+            break
+    return frozenset(found)
+
+
+def build_css(
+    config: BookConfig, tags: FrozenSet[str] = STYLED_ELEMENT_TAGS
+) -> str:
+    """Return the stylesheet for ``config``, reusing earlier results.
+
+    Rules for element tags missing from ``tags`` are left out so WeasyPrint
+    has less CSS to parse and cascade.
+    """
+
+    values = tuple(getattr(config, name) for name in CSS_CONFIG_FIELDS)
+    try:
+        return render_css_cached(values, tags)
+    except TypeError:
+        # An unhashable value (e.g. a YAML list) just skips the memo.
+        return render_css(config, tags)
+
+
+@functools.lru_cache(maxsize=8)
+def render_css_cached(values: Tuple[Any, ...], tags: FrozenSet[str]) -> str:
+    """Render the stylesheet for the ``CSS_CONFIG_FIELDS`` values of a config."""
+
+    return render_css(BookConfig(**dict(zip(CSS_CONFIG_FIELDS, values))), tags)
+
+
+def render_css(
+    config: BookConfig, tags: FrozenSet[str] = STYLED_ELEMENT_TAGS
+) -> str:
     header_footer_css = ""
     if config.header_enabled:
         header_footer_css += f"""
@@ -403,7 +938,8 @@ def build_css(config: BookConfig) -> str:
     }}
         """
 
-    return f"""
+    blocks: List[str] = [
+        f"""
     @page {{
         size: {config.page_size};
         margin: {config.margin_top} {config.margin_right} {config.margin_bottom} {config.margin_left};
@@ -478,7 +1014,12 @@ def build_css(config: BookConfig) -> str:
           {config.font_family};
         font-synthesis: style;
     }}
+        """
+    ]
 
+    if {"pre", "code"} & tags:
+        blocks.append(
+            f"""
     pre, code {{
         font-family:
           {config.code_font_family};
@@ -500,20 +1041,35 @@ def build_css(config: BookConfig) -> str:
         white-space: pre-wrap;
         word-break: break-word;
     }}
+        """
+        )
 
+    if "blockquote" in tags:
+        blocks.append(
+            f"""
     blockquote {{
         border-left: 4px solid {config.link_color};
         padding-left: 12px;
         color: #555;
         margin-left: 0;
     }}
+        """
+        )
 
+    if "hr" in tags:
+        blocks.append(
+            f"""
     hr {{
         border: none;
         border-top: 1px dashed {config.code_border_color};
         margin: 24px 0;
     }}
+        """
+        )
 
+    if "table" in tags:
+        blocks.append(
+            f"""
     table {{
         border-collapse: collapse;
         width: 100%;
@@ -528,18 +1084,32 @@ def build_css(config: BookConfig) -> str:
         font-family:
           {config.table_font_family};
     }}
+        """
+        )
 
-    img {{
+    if "img" in tags:
+        blocks.append(
+            """
+    img {
         display: block;
         margin-left: auto;
         margin-right: auto;
         max-width: 100%;
-    }}
+    }
+        """
+        )
 
-    figure {{
+    if "figure" in tags:
+        blocks.append(
+            """
+    figure {
         text-align: center;
-    }}
+    }
+        """
+        )
 
+    blocks.append(
+        f"""
     .book-title {{
         text-align: center;
         margin-top: 28px;
@@ -560,45 +1130,59 @@ def build_css(config: BookConfig) -> str:
         page-break-before: {"always" if config.chapter_page_break else "auto"};
         page-break-after: auto;
     }}
+        """
+    )
 
-    .pdf-cover {{
+    if config.pdf_cover:
+        blocks.append(
+            """
+    .pdf-cover {
         page: cover;
         page-break-after: always;
         text-align: center;
         margin: 0;
         padding: 0;
-    }}
+    }
 
-    .pdf-cover img {{
+    .pdf-cover img {
         width: 100%;
         height: 100vh;
         object-fit: cover;
         display: block;
-    }}
+    }
 
-    @page cover {{
+    @page cover {
         margin: 0;
         counter-increment: none;
-        @top-left {{ content: none; }}
-        @top-right {{ content: none; }}
-        @bottom-center {{ content: none; }}
-        @top-center {{ content: none; }}
-    }}
+        @top-left { content: none; }
+        @top-right { content: none; }
+        @bottom-center { content: none; }
+        @top-center { content: none; }
+    }
+        """
+        )
 
-    .no-page-number {{
+    blocks.append(
+        """
+    .no-page-number {
         page: no-number;
-    }}
+    }
 
-    @page no-number {{
-        @top-right {{
+    @page no-number {
+        @top-right {
             content: none;
-        }}
-        @top-left {{
+        }
+        @top-left {
             content: none;
-        }}
+        }
         counter-increment: none;
-    }}
+    }
+        """
+    )
 
+    if config.toc:
+        blocks.append(
+            f"""
     .toc-title {{
         font-size: 1.6em;
         font-weight: bold;
@@ -648,7 +1232,11 @@ def build_css(config: BookConfig) -> str:
         text-align: right;
         order: 2;
     }}
+        """
+        )
 
+    blocks.append(
+        f"""
     .chapter-title {{
         text-align: center;
         font-family:
@@ -670,22 +1258,26 @@ def build_css(config: BookConfig) -> str:
         color: inherit;
         text-decoration: none;
     }}
+        """
+    )
 
-    {header_footer_css}
-    {config.extra_css}
-    """
+    blocks.append(header_footer_css)
+    blocks.append(config.extra_css)
+    return "\n".join(blocks)
 
 
-def render_html(chapters: Sequence[Chapter], config: BookConfig) -> Tuple[str, Path]:
-    if not chapters:
-        raise ValueError("No Markdown content found to render")
+@functools.lru_cache(maxsize=None)
+def render_author_html(author: str) -> str:
+    """Render the (Markdown) author line once per distinct value."""
+
+    return markdown.markdown(author, extensions=["attr_list"], output_format="html5")
+
+
+def iter_body_parts(chapters: Sequence[Chapter], config: BookConfig) -> Iterator[str]:
+    """Yield the book body piece by piece so callers can stream or join it."""
 
     base_path = chapters[0].source_path.parent
-    toc_headings: List[Tuple[int, str, str]] = []
-    author_html = markdown.markdown(
-        config.author, extensions=["attr_list"], output_format="html5"
-    )
-    body_parts: List[str] = []
+    author_html = render_author_html(config.author)
 
     if config.pdf_cover:
         cover_path = Path(config.pdf_cover).expanduser()
@@ -693,71 +1285,79 @@ def render_html(chapters: Sequence[Chapter], config: BookConfig) -> Tuple[str, P
             cover_path = (base_path / cover_path).resolve()
         if not cover_path.exists():
             raise FileNotFoundError(f"PDF cover image not found: {cover_path}")
-        body_parts.append(
-            f"<div class='pdf-cover'><img src='{cover_path.as_uri()}' alt='Book cover'></div>"
-        )
+        yield f"<div class='pdf-cover'><img src='{cover_path.as_uri()}' alt='Book cover'></div>"
 
-    body_parts.append(
+    yield (
         "<div class='book-meta no-page-number'>"
-        f"<h1 class='book-title'>{config.title}</h1>"
+        f"<h1 class='book-title'>{html.escape(config.title, quote=True)}</h1>"
         f"<div class='book-author'>{author_html}</div>"
         "</div>"
     )
 
     if config.footer_enabled:
-        body_parts.append(f"<div class='page-footer'>{config.footer_html}</div>")
+        yield f"<div class='page-footer'>{config.footer_html}</div>"
 
-    toc_insert_index = len(body_parts)
+    if config.toc:
+        toc_headings = [heading for chapter in chapters for heading in chapter.headings]
+        yield (
+            "<div class='toc no-page-number'>"
+            + build_nested_toc(toc_headings, config)
+            + "</div>"
+        )
 
-    for idx, chapter in enumerate(
-        tqdm(chapters, desc="Rendering chapters", unit="chapter"), start=1
-    ):
+    for chapter in tqdm(chapters, desc="Rendering chapters", unit="chapter"):
         anchor = chapter.anchor
-        chapter_html = chapter.html
-        if "chapter-title" not in chapter_html:
-            chapter_html = (
-                f"<h1 id='{anchor}' class='chapter-title'>{chapter.title}</h1>"
-                + chapter_html
-            )
-        if config.toc:
-            chapter_headings = collect_heading_links(chapter_html)
-            if not chapter_headings:
-                chapter_headings = [(1, anchor, chapter.title)]
-            toc_headings.extend(chapter_headings)
         chapter_url = f"{config.url_prefix.rstrip('/')}/{chapter.anchor}"
-        safe_title = html.escape(chapter.title)
         header_marker = (
             "<div class='chapter-header-title'>"
-            f"<a href='{chapter_url}'>{safe_title}</a>"
+            f"<a href='{chapter_url}'>{chapter.safe_title}</a>"
             "</div>"
         )
-        body_parts.append(
-            f"<section id='{anchor}' class='chapter'>{header_marker}{chapter_html}</section>"
-        )
+        yield f"<section id='{anchor}' class='chapter'>{header_marker}{chapter.html}</section>"
 
-    if config.toc:
-        toc_html = (
-            "<div class='toc'>"
-            + build_nested_toc(toc_headings, config)
-            + "</div>"
-        )
-        body_parts.insert(
-            toc_insert_index,
-            toc_html.replace("class='toc'", "class='toc no-page-number'"),
-        )
 
-    content = "".join(body_parts)
-    return (
-        f"<html><head><meta charset='utf-8'></head><body>{content}</body></html>",
-        base_path,
-    )
+def write_html_document(
+    body_parts: Iterable[str], output_path: Path, head_html: str = ""
+) -> None:
+    """Write a complete HTML document, streaming the body parts to disk."""
+
+    with output_path.open("w", encoding="utf-8", buffering=1 << 20) as handle:
+        handle.write(f"<html><head><meta charset='utf-8'>{head_html}</head><body>")
+        for part in body_parts:
+            handle.write(part)
+        handle.write("</body></html>")
+
+
+def render_html_to_file(
+    chapters: Sequence[Chapter], config: BookConfig, output_path: Path
+) -> Path:
+    """Write the book as a bare HTML document to ``output_path``.
+
+    Returns the base path for resolving relative assets.
+    """
+
+    if not chapters:
+        raise ValueError("No Markdown content found to render")
+
+    write_html_document(iter_body_parts(chapters, config), output_path)
+    return chapters[0].source_path.parent
+
 
+@functools.lru_cache(maxsize=8)
+def parse_stylesheet(css: str) -> CSS:
+    """Parse ``css`` once so repeated renders reuse WeasyPrint's rule tree."""
 
-def convert_to_pdf(
-    html_content: str, css: str, output_path: Path, base_url: Path
+    return CSS(string=css)
+
+
+def convert_file_to_pdf(
+    html_path: Path, css: Optional[str], output_path: Path, base_url: Path
 ) -> None:
-    HTML(string=html_content, base_url=str(base_url)).write_pdf(
-        stylesheets=[CSS(string=css)], target=str(output_path)
+    """Render ``html_path`` to PDF; pass ``css=None`` if the file embeds its styles."""
+
+    stylesheets = [] if css is None else [parse_stylesheet(css)]
+    HTML(filename=str(html_path), base_url=str(base_url)).write_pdf(
+        stylesheets=stylesheets, target=str(output_path)
     )
 
 
@@ -783,26 +1383,15 @@ def convert_to_epub(
     book.add_item(style)
 
     epub_chapters = []
-    added_resources: Dict[Path, epub.EpubItem] = {}
+    added_resources: Dict[str, epub.EpubItem] = {}
+    resources_by_digest: Dict[str, epub.EpubItem] = {}
     for idx, chapter in enumerate(chapters, start=1):
-        chapter_html = chapter.html or ""
-        chapter_html = chapter_html.strip()
-
-        if not chapter_html:
-            safe_title = html.escape(chapter.title)
-            chapter_html = f"<h1 id='{chapter.anchor}'>{safe_title}</h1>"
-        elif "chapter-title" not in chapter_html:
-            safe_title = html.escape(chapter.title)
-            chapter_html = (
-                f"<h1 id='{chapter.anchor}' class='chapter-title'>{safe_title}</h1>"
-                + chapter_html
-            )
-
-        for original_src, resource in discover_images(
-            chapter_html, chapter.source_path.parent, added_resources
-        ):
-            book.add_item(resource)
-            chapter_html = chapter_html.replace(original_src, resource.file_name)
+        chapter_html = embed_images(
+            chapter.html.strip(),
+            chapter.source_path.parent,
+            added_resources,
+            resources_by_digest,
+        )
 
         item = epub.EpubHtml(
             title=chapter.title,
@@ -814,6 +1403,9 @@ def convert_to_epub(
         book.add_item(item)
         epub_chapters.append(item)
 
+    for resource in resources_by_digest.values():
+        book.add_item(resource)
+
     book.toc = tuple(epub_chapters)
     book.spine = ["nav"] + epub_chapters
     book.add_item(epub.EpubNcx())
@@ -848,7 +1440,7 @@ def convert_to_mobi(epub_path: Path, output_path: Path) -> None:
 
 
 def resolve_sources(
-    sources: Sequence[str],
+    sources: Sequence[str], use_cache: bool = True
 ) -> Tuple[List[Path], Optional[tempfile.TemporaryDirectory]]:
     temp_dir: Optional[tempfile.TemporaryDirectory] = None
     paths: List[Path] = []
@@ -859,6 +1451,10 @@ def resolve_sources(
             or src.startswith("https://")
             or src.startswith("git@")
         ):
+            if use_cache and repo_cache_writable():
+                # Git failures propagate: a throwaway clone would fail the same way.
+                paths.append(update_cached_repository(src))
+                continue
             temp_dir = tempfile.TemporaryDirectory()
             repo_path = clone_repository(src, Path(temp_dir.name))
             paths.append(repo_path)
@@ -904,20 +1500,43 @@ def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
         default=None,
         help="Path to an image that will be placed on the first PDF page as a cover.",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes used to parse Markdown files (default: CPU count).",
+    )
+    parser.add_argument(
+        "--parser",
+        choices=PARSERS,
+        default="markdown",
+        help=(
+            "Markdown implementation: python-markdown (default) or the faster "
+            "markdown-it-py, which must be installed separately."
+        ),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=(
+            "Re-parse every Markdown file and re-clone repositories instead of "
+            f"reusing results cached in {CACHE_DIR}."
+        ),
+    )
     return parser.parse_args(argv)
 
 
 def convert_to_html(
-    html_content: str, css: str, output_path: Path, base_url: Path
+    body_parts: Iterable[str], css: str, output_path: Path, base_url: Path
 ) -> None:
-    head_injection = f"<style>{css}</style><base href='{base_url.as_uri()}/'>"
-    if "</head>" in html_content:
-        styled_html = html_content.replace("</head>", f"{head_injection}</head>", 1)
-    else:
-        styled_html = (
-            f"<head><meta charset='utf-8'>{head_injection}</head>" + html_content
-        )
-    output_path.write_text(styled_html, encoding="utf-8")
+    """Write a standalone HTML file, streaming the body parts to disk."""
+
+    write_html_document(
+        body_parts,
+        output_path,
+        head_html=f"<style>{css}</style><base href='{base_url.as_uri()}/'>",
+    )
 
 
 def main(argv: Optional[Sequence[str]] = None) -> None:
@@ -925,57 +1544,96 @@ def main(argv: Optional[Sequence[str]] = None) -> None:
     config = BookConfig.from_yaml(args.config)
     if args.pdf_cover is not None:
         config.pdf_cover = str(args.pdf_cover.expanduser())
-    source_paths, temp_dir = resolve_sources(args.sources)
+    source_paths, temp_dir = resolve_sources(args.sources, use_cache=not args.no_cache)
+    # One pool serves both chapter parsing and the background EPUB build.
+    executor = ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
 
     try:
         markdown_files = discover_markdown_files(source_paths)
         if not markdown_files:
             raise SystemExit("No Markdown files found in provided sources")
 
-        markdown_files = [
-            path
-            for path in markdown_files
-            if path.stem.lower() not in {page.lower() for page in config.exclude_pages}
-        ]
+        exclude = frozenset(page.lower() for page in config.exclude_pages)
+        markdown_files = filter_and_prioritize(markdown_files, exclude)
         if not markdown_files:
             raise SystemExit("No Markdown files found after applying exclusions")
-        markdown_files = prioritize_files(markdown_files)
 
-        chapters = load_chapters(markdown_files)
-        css = build_css(config)
+        chapters = load_chapters(
+            markdown_files,
+            use_cache=not args.no_cache,
+            jobs=args.jobs,
+            parser=args.parser,
+            executor=executor,
+        )
 
-        html_content: Optional[str] = None
-        base_url: Optional[Path] = None
         epub_path: Optional[Path] = None
+        styled_tags = collect_styled_tags(chapters, config)
+
+        epub_future: Optional["Future[None]"] = None
+        if args.format in {"both", "all"} and executor is not None:
+            # The EPUB shares nothing with the PDF, so build it in a worker
+            # process while WeasyPrint renders.
+            epub_future = executor.submit(
+                convert_to_epub,
+                chapters,
+                config,
+                build_css(config, styled_tags),
+                args.output.with_suffix(".epub"),
+            )
 
-        if args.format in {"pdf", "both", "html", "all"}:
-            html_content, base_url = render_html(chapters, config)
+        html_target: Optional[Path] = None
+        if args.format in {"html", "all"}:
+            html_target = args.output.with_suffix(".html")
+            convert_to_html(
+                iter_body_parts(chapters, config),
+                build_css(config, styled_tags),
+                html_target,
+                chapters[0].source_path.parent,
+            )
+            print(f"HTML created at {html_target}")
 
-        if args.format in {"pdf", "both", "all"} and html_content and base_url:
+        if args.format in {"pdf", "both", "all"}:
             pdf_path = args.output.with_suffix(".pdf")
-            convert_to_pdf(html_content, css, pdf_path, base_url)
+            if html_target is not None:
+                # The standalone HTML already embeds the stylesheet; render it
+                # instead of generating the body a second time.
+                convert_file_to_pdf(
+                    html_target, None, pdf_path, chapters[0].source_path.parent
+                )
+            else:
+                # Hand WeasyPrint a file rather than one large in-memory string.
+                with tempfile.TemporaryDirectory() as scratch_dir:
+                    html_path = Path(scratch_dir) / "book.html"
+                    base_url = render_html_to_file(chapters, config, html_path)
+                    convert_file_to_pdf(
+                        html_path, build_css(config, styled_tags), pdf_path, base_url
+                    )
             print(f"PDF created at {pdf_path}")
 
-        if args.format in {"html", "all"} and html_content and base_url:
-            html_path = args.output.with_suffix(".html")
-            convert_to_html(html_content, css, html_path, base_url)
-            print(f"HTML created at {html_path}")
-
         if args.format in {"epub", "both", "all", "mobi"}:
             epub_path = args.output.with_suffix(".epub")
-            convert_to_epub(chapters, config, css, epub_path)
+            if epub_future is not None:
+                epub_future.result()
+            else:
+                convert_to_epub(
+                    chapters, config, build_css(config, styled_tags), epub_path
+                )
             print(f"EPUB created at {epub_path}")
 
         if args.format in {"mobi", "all"}:
             if epub_path is None:
                 epub_path = args.output.with_suffix(".epub")
-                convert_to_epub(chapters, config, css, epub_path)
+                convert_to_epub(
+                    chapters, config, build_css(config, styled_tags), epub_path
+                )
                 print(f"EPUB created at {epub_path}")
             mobi_path = args.output.with_suffix(".mobi")
             convert_to_mobi(epub_path, mobi_path)
             print(f"MOBI created at {mobi_path}")
 
     finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
         if temp_dir is not None:
             temp_dir.cleanup()
 